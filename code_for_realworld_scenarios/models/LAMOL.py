@@ -1,17 +1,18 @@
-import numpy as np
+import copy
 import logging
 import torch
+import torch.nn.functional as F
 import os
 import pickle
 import transformers
 from typing import List
-from datasets import Dataset
 from torch.utils.data import ConcatDataset, DataLoader
+from accelerate.utils import gather_object, broadcast_object_list, DistributedType
 
 from utils.metric import ResultSummary
 from utils.backbone import get_backbone
 from utils.optimizer import get_optimizer
-from utils.dataloader import get_dataloader, preprocess_function_train_generative_LAMOL
+from utils.dataloader import get_dataloader, preprocess_function_train_generative_LAMOL, TensorDictDataset
 from utils.buffer import get_buffer
 from utils.evaluation import evaluate_sent_level_acc_with_generation
 from utils.datatypes import STR2BOOL
@@ -31,6 +32,12 @@ def get_LAMOL_params(parser):
     parser.add_argument("--LAMOL_use_eos_as_gen_token", type=STR2BOOL, default=False, help="If using EOS token for generating psesudo old samples.")
     parser.add_argument("--LAMOL_use_ans_token", type=STR2BOOL, default=True, help="If using ANS token for generating psesudo old samples.")
     parser.add_argument("--LAMOL_ans_split_token", type=str, default=None, help="If LAMOL_use_ans_token is False, model will use LAMOL_ans_split_token to split questions and answers for pseudo samples.")
+    parser.add_argument("--LAMOL_gen_dtype", type=str, default='bfloat16', choices=['float32','float16','bfloat16'], help="The autocast dtype for generating psesudo old samples ('float32' disables autocast).")
+    parser.add_argument("--LAMOL_empty_cache_every", type=int, default=0, help="Call torch.cuda.empty_cache() every n epochs (default=0 means that the cache is only emptied at the end of each task).")
+    parser.add_argument("--LAMOL_pseudo_cache_path", type=str, default=None, help="The path of the psesudo old samples saved before (e.g., the dump_path of a previous run). default=None means always regenerating psesudo old samples.")
+    parser.add_argument("--LAMOL_torch_compile", type=STR2BOOL, default=False, help="If using torch.compile for the forward pass in training (generation still uses the original model).")
+    parser.add_argument("--LAMOL_gen_batch_size", type=int, default=64, help="The batch size for generating psesudo old samples (the prompts of all previous tasks are generated together).")
+    parser.add_argument("--LAMOL_nonfinite_check_steps", type=int, default=25, help="Check if the loss is NaN or Inf every n optimizer updates and skip the update if so (default=0 means no checking; not used with DeepSpeed).")
 
 
 class LAMOL(BaseLearner):
@@ -69,6 +76,8 @@ class LAMOL(BaseLearner):
         self.train_loader_list, self.dev_loader_list, self.test_loader_list = get_dataloader(self.params, self.CL_dataset, self.tokenizer)
         # Adding Special Tokens such as __ans__, __gen__
         self.model.resize_token_embeddings(len(self.tokenizer))
+        # Use KV-cache when generating pseudo samples
+        self.model.config.use_cache = True
 
     def build_buffer(self):
         self.buffer = None
@@ -77,6 +86,12 @@ class LAMOL(BaseLearner):
         self.model, self.optimizer, *self.train_loader_list = self.accelerator.prepare(self.model, self.optimizer, *self.train_loader_list)
         self.dev_loader_list = self.accelerator.prepare(*self.dev_loader_list)
         self.test_loader_list = self.accelerator.prepare(*self.test_loader_list)
+        # For Distributed Data Parallel
+        self._unwrapped_model = self.accelerator.unwrap_model(self.model)
+        if self.params.LAMOL_torch_compile:
+            self._compiled_model = torch.compile(self._unwrapped_model, mode='reduce-overhead', fullgraph=False)
+        else:
+            self._compiled_model = self._unwrapped_model
     # =============================================================================================
 
     # ================================= Task-Level Functions =======================================
@@ -102,7 +117,12 @@ class LAMOL(BaseLearner):
                 ConcatDataset((train_dataset,*pseudo_buf_dataset_list)),
                 batch_size=self.params.batch_size,
                 shuffle=True,
-                drop_last=False
+                drop_last=False,
+                pin_memory=True,
+                num_workers=self.params.num_workers,
+                # Keep workers alive across the epochs of the same task
+                persistent_workers=self.params.num_workers>0,
+                prefetch_factor=max(2,self.params.prefetch_factor) if self.params.num_workers>0 else None
             )
             cur_train_loader = self.accelerator.prepare(cur_train_loader)
         else:
@@ -122,6 +142,15 @@ class LAMOL(BaseLearner):
 
             self.end_epoch(task_id, epoch_id)
 
+        # NOTE: The prepared dataloader is still referenced by the accelerator after this task,
+        # so the persistent workers (and their copies of the datasets) are shut down explicitly.
+        if task_id>0:
+            if getattr(cur_train_loader,'_iterator',None) is not None:
+                cur_train_loader._iterator._shutdown_workers()
+                cur_train_loader._iterator = None
+            if cur_train_loader in self.accelerator._dataloaders:
+                self.accelerator._dataloaders.remove(cur_train_loader)
+
     def begin_epoch(self, task_id, epoch_id):
         '''
             Start of each epoch
@@ -130,7 +159,15 @@ class LAMOL(BaseLearner):
         if ((self.params.evaluate_interval>0) and (epoch_id>0 and epoch_id%self.params.evaluate_interval==0)) or \
             (self.params.is_evaluate_init and task_id==0 and epoch_id==0):
             self.evaluate_model(task_id=task_id)
-        self.loss_list = []
+        # NOTE: The running loss is kept on GPU to avoid synchronization (e.g., .item()) in every step
+        self._loss_sum = torch.zeros((), device=self.accelerator.device)
+        self._loss_count = torch.zeros((), device=self.accelerator.device) # the number of steps with finite loss
+        self._loss_steps = 0
+        self._window_loss = torch.zeros((), device=self.accelerator.device) # the loss summed since the last non-finite check
+        self._num_updates = 0
+        # NOTE: DeepSpeed updates the parameters in accelerator.backward(), so optimizer.step() can not be skipped
+        self._is_check_nonfinite = self.params.LAMOL_nonfinite_check_steps>0 and \
+                                    self.accelerator.distributed_type!=DistributedType.DEEPSPEED
         self.model.train()
 
     def observe_batch(self, task_id, epoch_id, lm_input):
@@ -142,37 +179,74 @@ class LAMOL(BaseLearner):
         self.global_step += 1
 
         # For Distributed Data Parallel
-        if hasattr(self.model,'module'):
-            model = self.model.module
-        else:
-            model = self.model
-
-        # Compute loss
-        # Training with Causal Language Modeling Loss
-            
-        qa_loss = model(**{'input_ids':lm_input['input_ids_with_ans'], 
-                                'attention_mask':lm_input['attention_mask_with_ans'],
-                                'labels':lm_input['labels_with_ans']}).loss
-
-        generation_loss = model(**{'input_ids':lm_input['input_ids_with_gen_ans'], 
-                                'attention_mask':lm_input['attention_mask_with_gen_ans'],
-                                'labels':lm_input['labels_with_gen_ans']}).loss
-
-        total_loss = qa_loss + self.params.LAMOL_lambda*generation_loss
-
-        # Backward
-        model.train()
-        self.optimizer.zero_grad()        
-        self.accelerator.backward(total_loss)
-        
-        scalar_loss = total_loss.item()
-        if not(np.isnan(scalar_loss)) or not(np.isinf(scalar_loss)):
-            self.optimizer.step()
-            self.loss_list.append(scalar_loss)
+        model = self._unwrapped_model
+
+        # Gradient accumulation
+        with self.accelerator.accumulate(self.model):
+
+            # Compute loss
+            # Training with Causal Language Modeling Loss
+            # NOTE: The QA target and the generation target are computed in a single forward pass
+            # by concatenating the two inputs along the batch dimension.
+            batch_size = lm_input['input_ids_with_ans'].shape[0]
+            max_len = max(lm_input['input_ids_with_ans'].shape[1], lm_input['input_ids_with_gen_ans'].shape[1])
+            input_ids_list, attention_mask_list, labels_list = [], [], []
+            for suffix in ['with_ans','with_gen_ans']:
+                # Left padding (padding_side=left for generative models) if the two inputs have different lengths
+                pad_len = max_len - lm_input['input_ids_%s'%(suffix)].shape[1]
+                input_ids_list.append(F.pad(lm_input['input_ids_%s'%(suffix)], (pad_len,0), value=self.tokenizer.pad_token_id))
+                attention_mask_list.append(F.pad(lm_input['attention_mask_%s'%(suffix)], (pad_len,0), value=0))
+                labels_list.append(F.pad(lm_input['labels_%s'%(suffix)], (pad_len,0), value=-100))
+
+            lm_logits = self._compiled_model(**{'input_ids':torch.cat(input_ids_list,dim=0), 
+                                                'attention_mask':torch.cat(attention_mask_list,dim=0)}).logits
+            labels = torch.cat(labels_list,dim=0)
+
+            # The same as the CausalLM loss in forward() of GPT Models, but averaged over each target separately
+            shift_logits = lm_logits[:, :-1, :].contiguous()
+            shift_labels = labels[:, 1:].contiguous()
+            token_loss = F.cross_entropy(shift_logits.view(-1, shift_logits.size(-1)), 
+                                         shift_labels.view(-1), 
+                                         ignore_index=-100, 
+                                         reduction='none').view(shift_labels.shape)
+            token_mask = (shift_labels!=-100)
+            qa_loss = token_loss[:batch_size].sum()/token_mask[:batch_size].sum()
+            generation_loss = token_loss[batch_size:].sum()/token_mask[batch_size:].sum()
+
+            total_loss = qa_loss + self.params.LAMOL_lambda*generation_loss
+
+            # Backward
+            model.train()
+            self.accelerator.backward(total_loss)
+            # NOTE: To avoid synchronization in every step, the losses are only checked every LAMOL_nonfinite_check_steps updates,
+            # and the update is skipped if any loss since the last check is NaN or Inf.
+            # The loss is reduced across processes so that all processes skip the same update.
+            if self._is_check_nonfinite:
+                self._window_loss += total_loss.detach()
+            if self.accelerator.sync_gradients:
+                self._num_updates += 1
+                if self._is_check_nonfinite and self._num_updates%self.params.LAMOL_nonfinite_check_steps==0:
+                    if torch.isfinite(self.accelerator.reduce(self._window_loss, reduction='sum')):
+                        self.optimizer.step()
+                    elif self.accelerator.is_main_process:
+                        logger.warning("Epoch %d, Step %d: Skip the update because of non-finite loss!"%(epoch_id+1, self.step))
+                    self._window_loss.zero_()
+                else:
+                    self.optimizer.step()
+            # NOTE: The optimizer only clears the gradients after gradient_accumulation_steps batches,
+            # so zero_grad() is called after step() to keep the accumulated gradients.
+            self.optimizer.zero_grad(set_to_none=True)
+
+        # Non-finite losses are excluded from the running loss and reported at the end of each epoch
+        detached_loss = total_loss.detach()
+        is_finite = torch.isfinite(detached_loss)
+        self._loss_sum += torch.where(is_finite, detached_loss, torch.zeros_like(detached_loss))
+        self._loss_count += is_finite.float()
+        self._loss_steps += 1
 
         # Print training information
         if self.params.info_per_steps and self.step%self.params.info_per_steps==0:
-            mean_loss = np.mean(self.loss_list)
+            mean_loss = self._loss_sum.item()/max(1,self._loss_count.item())
             if self.accelerator.is_main_process:
                 logger.info("Epoch %d, Step %d: Total_loss=%.3f,"%(
                         epoch_id+1, self.step, mean_loss
@@ -184,8 +258,13 @@ class LAMOL(BaseLearner):
             End of each epoch
         '''
         # Print training information
-        if len(self.loss_list)>0:
-            mean_loss = np.mean(self.loss_list)
+        loss_count = int(self._loss_count.item())
+        if loss_count<self._loss_steps and self.accelerator.is_main_process:
+            logger.warning("Epoch %d: %d/%d steps have non-finite loss!"%(
+                            epoch_id+1, self._loss_steps-loss_count, self._loss_steps
+                ))
+        if loss_count>0:
+            mean_loss = self._loss_sum.item()/loss_count
             if self.accelerator.is_main_process:
                 logger.info("Epoch %d, Step %d: Total_loss=%.3f"%(
                             epoch_id+1, self.step, mean_loss
@@ -208,7 +287,10 @@ class LAMOL(BaseLearner):
                     logger.info("Find better model!!")
 
         # Saving GPU memory
-        torch.cuda.empty_cache()
+        # NOTE: The caching allocator of PyTorch reuses the freed memory, and empty_cache() synchronizes the device.
+        # Therefore, the cache is only emptied every LAMOL_empty_cache_every epochs (and in end_task).
+        if self.params.LAMOL_empty_cache_every>0 and (epoch_id+1)%self.params.LAMOL_empty_cache_every==0:
+            torch.cuda.empty_cache()
     # ===========================================================================================
 
 
@@ -243,10 +325,7 @@ class LAMOL(BaseLearner):
             data_loader = self.test_loader_list
 
         # For Distributed Data Parallel
-        if hasattr(self.model,'module'):
-            model = self.model.module
-        else:
-            model = self.model
+        model = self._unwrapped_model
 
         if self.classifier_list is None:
             
@@ -267,7 +346,7 @@ class LAMOL(BaseLearner):
     # ===========================================================================================
 
     # ======================== Other Model-Specific Functions ===================================
-    def generate_pseudo_buffer_samples(self, task_id: int, num_samples: int) -> List[Dataset]:
+    def generate_pseudo_buffer_samples(self, task_id: int, num_samples: int) -> List[TensorDictDataset]:
         '''
             Generate pseudo old samples with generative models
 
@@ -280,10 +359,7 @@ class LAMOL(BaseLearner):
         '''
 
         # For Distributed Data Parallel
-        if hasattr(self.model,'module'):
-            model = self.model.module
-        else:
-            model = self.model
+        model = self._unwrapped_model
 
         input_column = 'input'
         target_column = 'target'
@@ -295,125 +371,228 @@ class LAMOL(BaseLearner):
         num_task = self.CL_dataset.continual_config['NUM_TASK']
 
         pseudo_dataset_list = []
-        
-        generate_batch_size = 8
+
+        cnt_num_samples = num_samples//task_id
+
+        gen_token_list = []
+        pesudo_samples_dict_list = []
+        for t_id in range(task_id):
+            if self.params.LAMOL_use_eos_as_gen_token:
+                gen_token_list.append(self.tokenizer.eos_token)
+            else:
+                gen_token_list.append('__%d__'%(t_id) if self.params.LAMOL_use_task_specific_gen_token else '__gen__')
+
+            # NOTE: The lists are preallocated with the target number of samples 
+            # and truncated to the number of valid pseudo samples after generation.
+            pesudo_samples_dict_list.append({
+                'input': [None]*cnt_num_samples, 'target': [None]*cnt_num_samples,
+            })
+        num_valid_samples_list = [0]*task_id
+
+        if self.params.il_mode == 'IIL':
+            pseudo_columns = ['input_ids','attention_mask','label_idx_cil','label_idx_til',
+                            'input_ids_with_ans', 'attention_mask_with_ans', 'labels_with_ans', 
+                            'input_ids_with_gen_ans', 'attention_mask_with_gen_ans', 'labels_with_gen_ans',
+                            'target', 'instance_id', 'concept_id', 'relation_id']
+        else:
+            if self.params.classifier == 'None':
+                pseudo_columns = ['input_ids','attention_mask', 'target', # 'label_idx_cil','label_idx_til',
+                                'input_ids_with_ans', 'attention_mask_with_ans', 'labels_with_ans', 
+                                'input_ids_with_gen_ans', 'attention_mask_with_gen_ans', 'labels_with_gen_ans']
+            else:
+                pseudo_columns = ['input_ids','attention_mask','label_idx_cil','label_idx_til',
+                                'input_ids_with_ans', 'attention_mask_with_ans', 'labels_with_ans', 
+                                'input_ids_with_gen_ans', 'attention_mask_with_gen_ans', 'labels_with_gen_ans']
+
+        # Load the pseudo samples saved before (e.g., when resuming an experiment) instead of regenerating them
+        # NOTE: The cache is only used when LAMOL_pseudo_cache_path is specified explicitly,
+        # because the pseudo samples in the current dump_path may be generated by a different model 
+        # (e.g., the failed attempt before find_executable_batch_size reduces the batch size).
+        cached_samples = [] # a list of (t_id, pesudo_samples_dict)
+        if self.params.LAMOL_pseudo_cache_path is not None:
+            if self.accelerator.is_main_process:
+                for t_id in range(task_id):
+                    pseudo_samples_file = os.path.join(self.params.LAMOL_pseudo_cache_path,f'Pseudo_Dataset_Train_{task_id}_Task_{t_id}.pkl')
+                    if not os.path.exists(pseudo_samples_file):
+                        continue
+                    with open(pseudo_samples_file,'rb') as f:
+                        pesudo_samples_dict = pickle.load(f)
+                    # The number of valid pseudo samples is at most cnt_num_samples (samples in the wrong format are dropped).
+                    # Otherwise, the pseudo samples are saved with different settings (e.g., LAMOL_gamma or dataset).
+                    num_cached_samples = len(pesudo_samples_dict['input'])
+                    if num_cached_samples>cnt_num_samples:
+                        logger.warning('Ignore %s because it contains %d pseudo samples for task %d but only %d samples are required!'%(
+                            pseudo_samples_file, num_cached_samples, t_id+1, cnt_num_samples))
+                        continue
+                    cached_samples.append((t_id, pesudo_samples_dict))
+                    logger.info('Load %d/%d pseudo samples for task %d from %s'%(num_cached_samples, cnt_num_samples, t_id+1, pseudo_samples_file))
+            # NOTE: The cache is only loaded on the main process and broadcast to the other processes,
+            # so that all processes agree on the tasks whose pseudo samples need to be generated.
+            cached_samples = broadcast_object_list([cached_samples])[0]
+        cached_task_ids = []
+        for t_id, pesudo_samples_dict in cached_samples:
+            pesudo_samples_dict_list[t_id] = pesudo_samples_dict
+            cached_task_ids.append(t_id)
+
+        # The previous tasks whose pseudo samples need to be generated
+        gen_task_ids = [t_id for t_id in range(task_id) if t_id not in cached_task_ids] if cnt_num_samples>0 else []
+        generate_batch_size = self.params.LAMOL_gen_batch_size
+
+        # A valid pseudo sample contains exactly one split token between the question and the answer
+        if self.params.LAMOL_use_ans_token:
+            split_token = '__ans__'
+        else:
+            assert self.params.LAMOL_ans_split_token is not None, \
+                "params.LAMOL_ans_split_token should be specified if params.LAMOL_use_ans_token is False"
+            split_token = self.params.LAMOL_ans_split_token
+
+        gen_dtype = getattr(torch, self.params.LAMOL_gen_dtype)
+        # NOTE: bfloat16 is not supported on GPUs before Ampere (e.g., V100 and T4)
+        if gen_dtype==torch.bfloat16 and model.device.type=='cuda' and not torch.cuda.is_bf16_supported():
+            if self.accelerator.is_main_process:
+                logger.warning('bfloat16 is not supported on the current device, and float16 is used for generating pseudo samples instead!')
+            gen_dtype = torch.float16
+        # NOTE: Start from the generation config of the backbone to keep its default sampling parameters (e.g., temperature, top_p)
+        gen_config = copy.deepcopy(model.generation_config)
+        gen_config.update(
+            do_sample=True,
+            top_k=self.params.LAMOL_topk,
+            pad_token_id=self.tokenizer.eos_token_id,
+            eos_token_id=self.tokenizer.eos_token_id,
+            use_cache=True,
+        )
+
+        # Tokenize the generation tokens of all previous tasks only once
+        # NOTE: padding_side=left for generative models
+        gen_token_lm_input = self.tokenizer(gen_token_list, padding='longest', return_tensors='pt')
+        gen_token_lm_input = {k:v.to(model.device) for k,v in gen_token_lm_input.items()}
+        gen_token_len_list = gen_token_lm_input['attention_mask'].sum(dim=1).tolist()
+
+        # Sort the tasks by prompt length so that the tasks generated together have prompts of similar lengths (less padding).
+        gen_task_ids = sorted(gen_task_ids, key=lambda t_id: gen_token_len_list[t_id])
+
+        # For Distributed Data Parallel, the tasks are sharded across processes and the pseudo samples are gathered after generation.
+        # NOTE: The parameters are partitioned in FSDP and DeepSpeed ZeRO-3, and thus all processes need to call generate together.
+        distributed_type = self.accelerator.distributed_type
+        is_shard_generation = self.accelerator.num_processes>1 and \
+            (distributed_type==DistributedType.MULTI_GPU or \
+             (distributed_type==DistributedType.DEEPSPEED and self.accelerator.state.deepspeed_plugin.zero_stage!=3))
+        if is_shard_generation:
+            gen_task_ids = gen_task_ids[self.accelerator.process_index::self.accelerator.num_processes]
+
+        # Each prompt is fed only once and expanded by num_return_sequences inside generate.
+        # When cnt_num_samples is smaller than generate_batch_size, the prompts of several tasks are generated together.
+        num_task_per_batch = max(1, generate_batch_size//max(1, cnt_num_samples))
 
         # To ignore the following debug information when use <|endoftext|> as the generation token: 
         # "A decoder-only architecture is being used, but right-padding was detected! For correct generation results, please set `padding_side='left'` when initializing the tokenizer."
         transformers.utils.logging.set_verbosity_error()
 
-        with torch.no_grad():
-        
-            for t_id in range(task_id):
+        with torch.inference_mode(), torch.autocast(device_type=model.device.type, 
+                                                    dtype=gen_dtype, 
+                                                    enabled=gen_dtype!=torch.float32):
 
-                if self.params.il_mode == 'IIL':
-                    pesudo_samples_dict = {
-                        'input': [], 'target': [], 'label_idx_cil': [], 'label_idx_til': [],
-                        'instance_id': [], 'concept_id': [], 'relation_id': [], 
-                    }
-                else:
-                    if self.params.classifier == 'None':
-                        pesudo_samples_dict = {
-                            'input': [], 'target': [], # 'label_idx_cil': [], 'label_idx_til': []
-                        }
-                    else:
-                        pesudo_samples_dict = {
-                            'input': [], 'target': [], 'label_idx_cil': [], 'label_idx_til': []
-                        }
-
-                cnt_num_samples = num_samples//task_id
-
-                if self.params.LAMOL_use_eos_as_gen_token:
-                    gen_token = self.tokenizer.eos_token
-                else:
-                    gen_token = '__%d__'%(t_id) if self.params.LAMOL_use_task_specific_gen_token else '__gen__'
+            for bg_idx in range(0, len(gen_task_ids), num_task_per_batch):
+
+                batch_task_ids = gen_task_ids[bg_idx:bg_idx+num_task_per_batch]
+
+                # Select the pre-tokenized prompts and remove the padding shared by all of them
+                max_input_len = max([gen_token_len_list[t_id] for t_id in batch_task_ids])
+                batch_idx = torch.tensor(batch_task_ids, device=model.device)
+                lm_input = {k:v[batch_idx,-max_input_len:] for k,v in gen_token_lm_input.items()}
 
-                while cnt_num_samples > 0:
-                        
-                    generate_num = generate_batch_size if cnt_num_samples>=generate_batch_size else cnt_num_samples
+                # Generate in chunks of at most generate_batch_size sequences to bound the memory
+                cnt_remain_samples = cnt_num_samples
+                while cnt_remain_samples>0:
 
-                    lm_input = self.tokenizer([gen_token for _ in range(generate_num)],
-                                                return_tensors='pt')
-                    lm_input = {k:v.to(model.device) for k,v in lm_input.items()}
-                    
-                    max_input_len = np.max([len(lm_input['input_ids'][i]) for i in range(generate_num)])
+                    num_return_sequences = min(cnt_remain_samples, max(1, generate_batch_size//len(batch_task_ids)))
 
                     generate_ids_all = model.generate(**lm_input, 
+                                            generation_config=gen_config,
                                             max_new_tokens=self.params.max_seq_length-max_input_len, 
-                                            pad_token_id=self.tokenizer.eos_token_id,
-                                            do_sample=True,
-                                            top_k=self.params.LAMOL_topk,
+                                            num_return_sequences=num_return_sequences,
                                             ) 
-                    generate_ids = generate_ids_all[:,max_input_len:].contiguous()
-                    generated_samples = self.tokenizer.batch_decode(generate_ids)
-
-                    for _one_sample in generated_samples:
-                        if self.params.LAMOL_use_ans_token:
-                            if _one_sample.count('__ans__')!=1:
-                                continue
-                            _question, _answer = _one_sample.split('__ans__')
-                        else:
-                            assert self.params.LAMOL_ans_split_token is not None, \
-                                "params.LAMOL_ans_split_token should be specified if params.LAMOL_use_ans_token is False"
-                            if _one_sample.count(self.params.LAMOL_ans_split_token)!=1:
-                                continue
-                            else:
-                                _question, _answer = _one_sample.split(self.params.LAMOL_ans_split_token)
-                                _question += self.params.LAMOL_ans_split_token
-                        _answer = _answer.replace(self.tokenizer.eos_token,'')
-                        pesudo_samples_dict['input'].append(_question)
-                        pesudo_samples_dict['target'].append(_answer)
-                        if self.params.classifier != 'None':
-                            pesudo_samples_dict['label_idx_cil'].append(-1)
-                            pesudo_samples_dict['label_idx_til'].append(-1)
-                        if self.params.il_mode == 'IIL':
-                            pesudo_samples_dict['instance_id'].append(-1)
-                            pesudo_samples_dict['concept_id'].append(-1)
-                            pesudo_samples_dict['relation_id'].append(-1)
-                        
-                        
-                    cnt_num_samples -= generate_num
-            
-                if len(pesudo_samples_dict['input'])==0:
-                    logger.error('No pseudo samples are generated in the correct format for task %d!'%(t_id+1))
-                    continue
-                with open(os.path.join(self.params.dump_path,f'Pseudo_Dataset_Train_{task_id}_Task_{t_id}.pkl'),'wb') as f:
-                    pickle.dump(pesudo_samples_dict,f)
-                pseudo_dataset = Dataset.from_dict(pesudo_samples_dict)
-                pseudo_dataset = pseudo_dataset.map(preprocess_function_train_generative_LAMOL, 
-                                                    batched=True, 
-                                                    desc='Generate pseudo samples for task %d'%(t_id+1), 
-                                                    batch_size=1000,
-                                                    fn_kwargs={
-                                                        'params':self.params,
-                                                        'tokenizer':self.tokenizer,
-                                                        'num_task':num_task,
-                                                        'task_id':t_id,
-                                                        'input_column':input_column,
-                                                        'target_column':target_column,
-                                                        'ans_token':ans_token,
-                                                        'eos_token':eos_token,
-                                                        'gen_token':gen_token,
-                                                    })
-                if self.params.il_mode == 'IIL':
-                    pseudo_dataset.set_format(type='torch', columns=['input_ids','attention_mask','label_idx_cil','label_idx_til',
-                                                                    'input_ids_with_ans', 'attention_mask_with_ans', 'labels_with_ans', 
-                                                                    'input_ids_with_gen_ans', 'attention_mask_with_gen_ans', 'labels_with_gen_ans',
-                                                                    'target', 'instance_id', 'concept_id', 'relation_id'])
-                else:
-                    if self.params.classifier == 'None':
-                        pseudo_dataset.set_format(type='torch', columns=['input_ids','attention_mask', 'target', # 'label_idx_cil','label_idx_til',
-                                                                        'input_ids_with_ans', 'attention_mask_with_ans', 'labels_with_ans', 
-                                                                        'input_ids_with_gen_ans', 'attention_mask_with_gen_ans', 'labels_with_gen_ans'])
-                    else:
-                        pseudo_dataset.set_format(type='torch', columns=['input_ids','attention_mask','label_idx_cil','label_idx_til',
-                                                                        'input_ids_with_ans', 'attention_mask_with_ans', 'labels_with_ans', 
-                                                                        'input_ids_with_gen_ans', 'attention_mask_with_gen_ans', 'labels_with_gen_ans'])
-
-                pseudo_dataset_list.append(pseudo_dataset)
+                    generate_ids = generate_ids_all[:,max_input_len:].cpu()
+                    # Only decode the tokens before the first EOS token (the following tokens are padding)
+                    is_eos = (generate_ids==self.tokenizer.eos_token_id)
+                    generate_len_list = torch.where(is_eos.any(dim=1), 
+                                                    is_eos.int().argmax(dim=1), 
+                                                    torch.full((generate_ids.shape[0],), generate_ids.shape[1])).tolist()
+                    generated_samples = self.tokenizer.batch_decode([_generate_ids[:_len] for _generate_ids, _len in zip(generate_ids, generate_len_list)],
+                                                                    skip_special_tokens=False)
+
+                    # NOTE: The returned sequences of the same prompt are adjacent
+                    sample_task_ids = [t_id for t_id in batch_task_ids for _ in range(num_return_sequences)]
+                    for t_id, _one_sample in zip(sample_task_ids, generated_samples):
+                        if _one_sample.count(split_token)!=1:
+                            continue
+                        _question, _answer = _one_sample.split(split_token)
+                        if not self.params.LAMOL_use_ans_token:
+                            _question += split_token
+                        sample_idx = num_valid_samples_list[t_id]
+                        pesudo_samples_dict_list[t_id]['input'][sample_idx] = _question
+                        pesudo_samples_dict_list[t_id]['target'][sample_idx] = _answer
+                        num_valid_samples_list[t_id] += 1
+
+                    cnt_remain_samples -= num_return_sequences
 
         transformers.utils.logging.set_verbosity_warning()
 
+        for t_id in range(task_id):
+            if t_id in cached_task_ids:
+                continue
+            num_valid_samples = num_valid_samples_list[t_id]
+            pesudo_samples_dict = {
+                'input': pesudo_samples_dict_list[t_id]['input'][:num_valid_samples],
+                'target': pesudo_samples_dict_list[t_id]['target'][:num_valid_samples],
+            }
+            # NOTE: The pseudo samples must have the same columns as the training set of the current task
+            # because they are merged in one ConcatDataset.
+            if self.params.classifier != 'None' or self.params.il_mode == 'IIL':
+                pesudo_samples_dict['label_idx_cil'] = [-1]*num_valid_samples
+                pesudo_samples_dict['label_idx_til'] = [-1]*num_valid_samples
+            if self.params.il_mode == 'IIL':
+                pesudo_samples_dict['instance_id'] = [-1]*num_valid_samples
+                pesudo_samples_dict['concept_id'] = [-1]*num_valid_samples
+                pesudo_samples_dict['relation_id'] = [-1]*num_valid_samples
+            pesudo_samples_dict_list[t_id] = pesudo_samples_dict
+
+        if is_shard_generation:
+            # NOTE: gather_object() concatenates the lists of all processes
+            gathered_samples = gather_object([(t_id, pesudo_samples_dict_list[t_id]) for t_id in gen_task_ids])
+            for t_id, pesudo_samples_dict in gathered_samples:
+                pesudo_samples_dict_list[t_id] = pesudo_samples_dict
+
+        # NOTE: The pseudo datasets are built outside inference_mode because their tensors are used for training
+        for t_id in range(task_id):
+
+            pesudo_samples_dict = pesudo_samples_dict_list[t_id]
+            gen_token = gen_token_list[t_id]
+        
+            if len(pesudo_samples_dict['input'])==0:
+                logger.error('No pseudo samples are generated in the correct format for task %d!'%(t_id+1))
+                continue
+            # NOTE: The cached pseudo samples are also saved so that the dump_path of every run is a complete cache
+            if self.accelerator.is_main_process:
+                with open(os.path.join(self.params.dump_path,f'Pseudo_Dataset_Train_{task_id}_Task_{t_id}.pkl'),'wb') as f:
+                    pickle.dump(pesudo_samples_dict,f)
+            # Tokenize all pseudo samples of the task at once and keep them in memory
+            pseudo_lm_inputs = preprocess_function_train_generative_LAMOL(pesudo_samples_dict,
+                                                                          params=self.params,
+                                                                          tokenizer=self.tokenizer,
+                                                                          num_task=num_task,
+                                                                          task_id=t_id,
+                                                                          input_column=input_column,
+                                                                          target_column=target_column,
+                                                                          ans_token=ans_token,
+                                                                          eos_token=eos_token,
+                                                                          gen_token=gen_token)
+            # NOTE: Keep the original columns (e.g., label_idx_cil) which are not returned by the preprocess function as Dataset.map() does
+            pseudo_lm_inputs = {**pesudo_samples_dict, **pseudo_lm_inputs}
+            pseudo_dataset = TensorDictDataset({k:pseudo_lm_inputs[k] for k in pseudo_columns})
+
+            pseudo_dataset_list.append(pseudo_dataset)
+
         return pseudo_dataset_list
 
     # ===========================================================================================
\ No newline at end of file
@@ -263,7 +263,8 @@ def obtain_generate_ids(params, model, lm_input, tokenizer):
                                         'input_ids':lm_input['input_ids'], 
                                         'attention_mask':lm_input['attention_mask']}, 
                                         max_new_tokens=params.backbone_max_new_token, 
-                                        pad_token_id=tokenizer.eos_token_id)
+                                        pad_token_id=tokenizer.eos_token_id,
+                                        use_cache=True)
     
     generate_ids = generate_ids_all[:,input_len:].contiguous()
 
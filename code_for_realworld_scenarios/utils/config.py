@@ -76,6 +76,8 @@ def get_params(default_cfg_path="./config/default_config.yaml",is_run_in_ipynb=F
     parser.add_argument("--is_evaluate_only", default=False, type=STR2BOOL, help="If only evaluate the model instead of incremental training?")
         
     parser.add_argument("--batch_size", type=int, default=4, help="Batch size") 
+    parser.add_argument("--num_workers", type=int, default=2, help="The number of worker processes for the merged training dataloader with pseudo samples in LAMOL (0 means loading data in the main process)") 
+    parser.add_argument("--prefetch_factor", type=int, default=4, help="The number of batches loaded in advance by each worker of the merged training dataloader in LAMOL (only used when num_workers>0)") 
     parser.add_argument("--max_seq_length", type=int, default=-1, help="Max length for each sentence (default=-1 means that max_seq_length will be decided according to the dataset automatically)") 
     parser.add_argument("--max_seq_length_list", type=list, default=None, help="Max length for each sentence for each task. If it is None, all tasks will be set to max_seq_length.") 
 
@@ -2,7 +2,7 @@ from copy import deepcopy
 from collections import Counter
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset
 
 from utils.prompt import get_prompt, get_prompt_LAMOL, get_prompt_PCLL
 
@@ -895,7 +895,8 @@ def get_dataloader_for_sentence_level_dataset_LAMOL(params, CL_dataset, tokenize
             DataLoader(train_dataset, 
                         batch_size=batch_size, 
                         shuffle=True,
-                        drop_last=False)
+                        drop_last=False,
+                        pin_memory=True)
         )
 
         dev_dataset = CL_dataset.continual_data[task_id]['dev']
@@ -1084,6 +1085,30 @@ def get_dataloader_for_word_level_dataset_default(params, CL_dataset, tokenizer)
 
 
 # ============================================= Other Functions =====================================================
+class TensorDictDataset(Dataset):
+    '''
+        An in-memory dataset which returns a dict for each sample, 
+        the same as datasets.Dataset after set_format(type='torch') but without Arrow serialization.
+
+        Args:
+         - data_dict: {column_name: list of values}. Numeric columns are converted to tensors 
+         and the other columns (e.g., target) are kept as lists of str.
+    '''
+    def __init__(self, data_dict: dict):
+        self.data_dict = {}
+        for k, v in data_dict.items():
+            if len(v)>0 and isinstance(v[0], str):
+                self.data_dict[k] = list(v)
+            else:
+                self.data_dict[k] = torch.tensor(v)
+        self.num_samples = len(next(iter(self.data_dict.values())))
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, idx):
+        return {k: v[idx] for k, v in self.data_dict.items()}
+
 def print_max_len_information(input_ids_list, max_seq_length: int) -> None:
     '''
         Print the statistics of the sentence length (>max_seq_length)
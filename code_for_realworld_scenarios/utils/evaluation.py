@@ -36,7 +36,7 @@ def evaluate_sent_level_acc_with_generation(model, eval_data_loader, tokenizer,
 
     assert metric in ['acc','rouge-l','edit-similarity','sari','jailbreak-rate'], f'Unsupport metric type {metric}!'
     
-    with torch.no_grad():
+    with torch.inference_mode():
         for lm_input in eval_data_loader: 
 
             label_idx = lm_input['label_idx_cil'] if idx2label is not None else None